@@ -28,6 +28,7 @@ Notas
 """
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_autorefresh import st_autorefresh   # ✅ CORRECCIÓN: usar este autorefresh
 import feedparser
 import pandas as pd
@@ -35,10 +36,13 @@ import numpy as np
 import re, hashlib, json, time
 from datetime import datetime, timezone, timedelta
 import pytz
+from dateutil import parser as date_parser
+from dateutil.tz import tzoffset
 import requests
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait
+from xml.etree import ElementTree
 import plotly.express as px
-from math import exp, log
 
 # === Ajustes visuales ===
 st.set_page_config(page_title="Radar de Noticias de Impacto", layout="wide", page_icon="🧭")
@@ -53,9 +57,12 @@ st.markdown(
 
 # === Configuración base ===
 APP_TZ = "America/Panama"
+_APP_TZ = pytz.timezone(APP_TZ)  # se construye una sola vez
 HALF_LIFE_HOURS = 6.0  # vida media del factor "recencia"
 MAX_ITEMS_PER_FEED = 50
 CACHE_TTL_MIN = 10     # minutos para refrescar feeds si hay autorefresh
+FETCH_WORKERS = 8      # descargas de feeds en paralelo
+FETCH_TIMEOUT_S = 20   # segundos máximos de espera para toda la descarga
 
 # Pesos por tipo de fuente (puedes ajustar)
 SOURCE_WEIGHTS = {
@@ -154,6 +161,24 @@ KEYWORD_TO_ASSETS = {
     "coinbase": ["BTCUSD", "ETHUSD"],
 }
 
+# Tabla fusionada keyword -> (peso, activos): una sola búsqueda por coincidencia
+KEYWORD_TABLE = {k: (w, tuple(KEYWORD_TO_ASSETS.get(k, ()))) for k, w in IMPACT_KEYWORDS.items()}
+
+# Abreviaturas de zona horaria frecuentes en los RSS, como desfases fijos
+# (EST siempre es UTC-5, aunque la fecha caiga en horario de verano)
+TZINFOS = {
+    abbr: tzoffset(abbr, hours * 3600)
+    for abbr, hours in {
+        "UTC": 0, "GMT": 0,
+        "EST": -5, "EDT": -4, "CST": -6, "CDT": -5,
+        "MST": -7, "MDT": -6, "PST": -8, "PDT": -7,
+        "BST": 1, "CET": 1, "CEST": 2,
+    }.items()
+}
+
+# Tickers estilo $TSLA / $AAPL (aportan a índices)
+TICKER_RE = re.compile(r"\$[A-Z]{1,5}")
+
 # Pares y activos típicos en binarias (filtro rápido)
 DEFAULT_WATCHLIST = ["EURUSD","GBPUSD","USDJPY","USDCHF","USDCAD","AUDUSD",
                      "XAUUSD","BTCUSD","ETHUSD","US500","DE40","OIL"]
@@ -188,85 +213,190 @@ def load_feeds():
         ]
 
 def tz_now():
-    return datetime.now(pytz.timezone(APP_TZ))
+    return datetime.now(_APP_TZ)
 
 def to_dt(entry):
-    # Intenta published_parsed, luego updated_parsed, sino ahora
+    # Intenta published_parsed, luego updated_parsed (ya los calculó feedparser),
+    # luego el texto crudo con dateutil, sino None
     if hasattr(entry, "published_parsed") and entry.published_parsed:
-        return datetime(*entry.published_parsed[:6], tzinfo=timezone.utc).astimezone(pytz.timezone(APP_TZ))
+        return datetime(*entry.published_parsed[:6], tzinfo=timezone.utc).astimezone(_APP_TZ)
     if hasattr(entry, "updated_parsed") and entry.updated_parsed:
-        return datetime(*entry.updated_parsed[:6], tzinfo=timezone.utc).astimezone(pytz.timezone(APP_TZ))
-    return tz_now()
-
-def domain_weight(link:str) -> float:
+        return datetime(*entry.updated_parsed[:6], tzinfo=timezone.utc).astimezone(_APP_TZ)
+    for field in ("published", "updated"):
+        raw = getattr(entry, field, None)
+        if raw:
+            try:
+                dt = date_parser.parse(raw, tzinfos=TZINFOS)
+                if dt.tzinfo is None:
+                    dt = dt.replace(tzinfo=timezone.utc)
+                return dt.astimezone(_APP_TZ)
+            except (ValueError, OverflowError):
+                pass
+    return None  # sin fecha: quien llama decide (no se congela "ahora" en el caché)
+
+def domain_weight_from_netloc(netloc:str) -> float:
     try:
-        netloc = urlparse(link).netloc.lower()
         parts = netloc.split(".")
         dom = ".".join(parts[-2:]) if len(parts)>=2 else netloc
         return SOURCE_WEIGHTS.get(dom, DEFAULT_SOURCE_WEIGHT)
     except Exception:
         return DEFAULT_SOURCE_WEIGHT
 
-def recency_score(dt: datetime) -> float:
-    hours = max((tz_now() - dt).total_seconds() / 3600.0, 0.0)
-    lam = log(2) / HALF_LIFE_HOURS
-    return exp(-lam * hours)
+def recency_score(hours):
+    """Decaimiento exponencial por antigüedad (acepta escalares o columnas)."""
+    lam = np.log(2) / HALF_LIFE_HOURS
+    return np.exp(-lam * np.maximum(hours, 0.0))
 
 def detect_assets_and_impact(text: str):
+    """Las keywords se buscan en minúsculas; el regex de tickers usa el texto original."""
     text_l = text.lower()
     impact = 0.0
     assets = set()
-    for k, w in IMPACT_KEYWORDS.items():
+    for k, (w, kw_assets) in KEYWORD_TABLE.items():
         if k in text_l:
             impact += w
-            assets.update(KEYWORD_TO_ASSETS.get(k, []))
+            assets.update(kw_assets)
 
-    # Regex de tickers estilo $TSLA / $AAPL (aportan a índices)
-    for m in re.findall(r"\$[A-Z]{1,5}", text):
-        assets.add("US100")
-        assets.add("US500")
+    # Basta con un ticker: no usamos cuáles son, solo que existan
+    if TICKER_RE.search(text):
+        assets.update(("US100", "US500"))
 
-    return sorted(list(assets)), impact
+    return sorted(assets), impact
 
 def hash_id(title:str, link:str) -> str:
-    h = hashlib.sha256()
-    h.update((title or "").encode("utf-8"))
-    h.update((link or "").encode("utf-8"))
-    return h.hexdigest()[:16]
+    # Clave de deduplicación (no criptográfica): 8 bytes -> 16 hex
+    return hashlib.blake2b(((title or "") + "\x1f" + (link or "")).encode("utf-8"), digest_size=8).hexdigest()
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+class _TeeReader:
+    """Envuelve un stream y guarda lo leído, para reparsearlo sin volver a descargar."""
+    def __init__(self, raw):
+        self.raw = raw
+        self.chunks = []
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        self.chunks.append(chunk)
+        return chunk
+
+    def read_all(self) -> bytes:
+        return b"".join(self.chunks) + self.raw.read()
+
+def fetch_feed_capped(url: str, max_items: int = MAX_ITEMS_PER_FEED):
+    """Descarga el feed en streaming y deja de leer tras `max_items` entradas.
+    Si el XML no se puede recorrer (p. ej. entidades HTML como &nbsp;), le pasa
+    a feedparser lo ya leído más el resto del stream, sin una segunda descarga."""
+    headers = {"User-Agent": feedparser.USER_AGENT}
+    with requests.get(url, stream=True, timeout=10, headers=headers) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        src = _TeeReader(resp.raw)
+        items, atom = [], False
+        try:
+            for _, elem in ElementTree.iterparse(src, events=("end",)):
+                ns, _, tag = elem.tag.rpartition("}")
+                if tag in ("item", "entry"):
+                    atom = atom or ns.lstrip("{") == ATOM_NS
+                    items.append(ElementTree.tostring(elem, encoding="unicode"))
+                    if len(items) >= max_items:
+                        break
+        except ElementTree.ParseError:
+            return feedparser.parse(src.read_all())
+    body = "".join(items)
+    if atom:
+        doc = f'<feed xmlns="{ATOM_NS}">{body}</feed>'
+    else:
+        doc = f'<rss version="2.0"><channel>{body}</channel></rss>'
+    return feedparser.parse(doc.encode("utf-8"))
+
+@st.cache_data(ttl=CACHE_TTL_MIN*60, show_spinner=False)
+def _parse_feed(url: str, max_items: int = MAX_ITEMS_PER_FEED) -> list[dict]:
+    """Parsea un feed y devuelve entradas normalizadas (dicts simples, cacheables)."""
+    parsed = fetch_feed_capped(url, max_items)
+    entries = []
+    for e in parsed.entries[:max_items]:
+        dt = to_dt(e)
+        entries.append({
+            "title": getattr(e, "title", "") or "",
+            "summary": getattr(e, "summary", "") or "",
+            "link": getattr(e, "link", "") or "",
+            "published_iso": dt.isoformat() if dt else None,
+        })
+    return entries
+
+def _parse_one(url: str, max_items: int = MAX_ITEMS_PER_FEED):
+    """Descarga y parsea un feed (IO-bound, se ejecuta en un hilo)."""
+    return url, _parse_feed(url, max_items)
 
 def fetch_all(feeds, max_items=MAX_ITEMS_PER_FEED):
-    rows = []
-    for url in feeds:
+    # Descarga concurrente: la latencia de red de cada feed se solapa
+    # (plazo global: los feeds que no terminen a tiempo se descartan sin esperarlos)
+    # Los hilos heredan el contexto del script para que st.cache_data funcione en ellos
+    ex = ThreadPoolExecutor(max_workers=FETCH_WORKERS, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+    futures = [ex.submit(_parse_one, url, max_items) for url in feeds]
+    done, _ = wait(futures, timeout=FETCH_TIMEOUT_S)
+    ex.shutdown(wait=False, cancel_futures=True)
+    results = []
+    for fut in futures:
+        if fut in done and fut.exception() is None:
+            results.append(fut.result())
+
+    # Columnas en listas separadas: pandas recibe arrays directamente
+    ids, times, titles, summaries, links = [], [], [], [], []
+    assets_l, assets_strs, impacts, sources = [], [], [], []
+    now = tz_now()
+    for url, entries in results:
         try:
-            parsed = feedparser.parse(url)
-            for e in parsed.entries[:max_items]:
-                title = getattr(e, "title", "") or ""
-                summary = getattr(e, "summary", "") or ""
-                link = getattr(e, "link", "") or ""
-                dt = to_dt(e)
-                assets, impact = detect_assets_and_impact(f"{title} {summary}")
-                source_w = domain_weight(link)
-                rec = recency_score(dt)
-                buzz = rec * (0.6 + 0.3*impact + 0.1*source_w)
-                rows.append({
-                    "id": hash_id(title, link),
-                    "time": dt,
-                    "time_ago_min": int(max((tz_now() - dt).total_seconds() / 60.0, 0)),
-                    "title": title,
-                    "summary": summary,
-                    "link": link,
-                    "assets": ", ".join(assets) if assets else "",
-                    "impact": round(impact, 3),
-                    "source_weight": round(source_w, 3),
-                    "recency": round(rec, 3),
-                    "buzz_score": round(buzz, 5),
-                    "source": urlparse(link).netloc or urlparse(url).netloc,
-                })
+            for e in entries:
+                title = e["title"]
+                summary = e["summary"]
+                link = e["link"]
+                if not link:
+                    continue  # sin link no hay clave de deduplicación útil
+                dt = datetime.fromisoformat(e["published_iso"]) if e["published_iso"] else now
+                if title or summary:
+                    assets, impact = detect_assets_and_impact(f"{title} {summary}")
+                else:
+                    assets, impact = [], 0.0
+                source = urlparse(link).netloc.lower() or urlparse(url).netloc.lower()
+                ids.append(hash_id(title, link))
+                times.append(dt)
+                titles.append(title)
+                summaries.append(summary)
+                links.append(link)
+                assets_l.append(assets)
+                assets_strs.append(", ".join(assets))
+                impacts.append(impact)
+                sources.append(source)
         except Exception:
             continue
-    if not rows:
-        return pd.DataFrame(columns=["id","time","time_ago_min","title","summary","link","assets","impact","source_weight","recency","buzz_score","source"])
-    df = pd.DataFrame(rows).drop_duplicates(subset=["id"])
+    if not ids:
+        return pd.DataFrame(columns=["id","time","time_ago_min","title","summary","link","assets","assets_str","impact","source_weight","recency","buzz_score","source"])
+    df = pd.DataFrame({
+        "id": ids,
+        "time": times,
+        "title": titles,
+        "summary": summaries,
+        "link": links,
+        "assets": assets_l,
+        "assets_str": assets_strs,
+        "impact": np.asarray(impacts, dtype=np.float32),
+        "source": pd.Categorical(sources),
+    }).drop_duplicates(subset=["id"])
+
+    # Peso por dominio: una búsqueda por categoría (K dominios), no por fila (N entradas)
+    src_w = np.asarray(df["source"].cat.categories.map(domain_weight_from_netloc), dtype=np.float32)
+    df["source_weight"] = src_w[df["source"].cat.codes.to_numpy()]
+
+    # Métricas derivadas vectorizadas (una operación por columna, no por fila)
+    delta_sec = (pd.Timestamp(now) - pd.to_datetime(df["time"], utc=True)).dt.total_seconds().clip(lower=0)
+    df["time_ago_min"] = (delta_sec / 60.0).astype(int)
+    df["recency"] = recency_score(delta_sec / 3600.0)
+    df["buzz_score"] = df["recency"] * (0.6 + 0.3*df["impact"] + 0.1*df["source_weight"])
+    df = df[["id","time","time_ago_min","title","summary","link","assets","assets_str","impact","source_weight","recency","buzz_score","source"]]
+    # Tipos compactos: float32 para puntajes, category para textos repetidos (se redondea solo al mostrar)
+    df = df.astype({"recency":"float32","buzz_score":"float32","assets_str":"category"})
     return df.sort_values("buzz_score", ascending=False).reset_index(drop=True)
 
 def aggregate_trends(df: pd.DataFrame, within_minutes: int = 360):
@@ -278,25 +408,23 @@ def aggregate_trends(df: pd.DataFrame, within_minutes: int = 360):
     if dff.empty:
         return pd.DataFrame(columns=["asset","count","avg_buzz"])
 
-    assets_expanded = []
-    for _, r in dff.iterrows():
-        assets = [a.strip() for a in (r["assets"] or "").split(",") if a.strip()]
-        if not assets:
-            continue
-        for a in assets:
-            assets_expanded.append((a, r["buzz_score"]))
-
-    if not assets_expanded:
+    s = dff.explode("assets").rename(columns={"assets": "asset"})
+    s = s[s["asset"].notna()]
+    if s.empty:
         return pd.DataFrame(columns=["asset","count","avg_buzz"])
 
-    tmp = pd.DataFrame(assets_expanded, columns=["asset","buzz"])
-    grp = tmp.groupby("asset").agg(count=("asset","count"), avg_buzz=("buzz","mean")).reset_index()
+    grp = s.groupby("asset").agg(count=("asset","size"), avg_buzz=("buzz_score","mean")).reset_index()
     return grp.sort_values(["count","avg_buzz"], ascending=[False, False]).reset_index(drop=True)
 
+@st.cache_resource(show_spinner=False)
+def _tg_session():
+    """Sesión HTTP compartida: reutiliza la conexión TLS con api.telegram.org."""
+    return requests.Session()
+
 def send_telegram(token: str, chat_id: str, text: str) -> bool:
     try:
         url = f"https://api.telegram.org/bot{token}/sendMessage"
-        r = requests.post(url, json={"chat_id": chat_id, "text": text, "disable_web_page_preview": True, "parse_mode":"HTML"}, timeout=10)
+        r = _tg_session().post(url, json={"chat_id": chat_id, "text": text, "disable_web_page_preview": True, "parse_mode":"HTML"}, timeout=10)
         return r.status_code == 200
     except Exception:
         return False
@@ -331,6 +459,7 @@ feeds = load_feeds()
 st.write(f"Fuentes activas: {len(feeds)}")
 if st.button("Actualizar ahora"):
     st.session_state["last_fetch"] = 0  # fuerza refresco abajo
+    _parse_feed.clear()                 # y descarta los feeds cacheados
 
 # Control de autorefresco (✅ usando st_autorefresh)
 now_ts = time.time()
@@ -353,7 +482,8 @@ if df.empty:
 # Filtro por watchlist
 wl = [w.strip().upper() for w in watchlist_txt.split(",") if w.strip()]
 if wl:
-    mask = df["assets"].apply(lambda s: any(w in s for w in wl))
+    wl_set = frozenset(wl)
+    mask = df["assets"].map(lambda lst: not wl_set.isdisjoint(lst))
     df_w = df[mask].copy()
 else:
     df_w = df.copy()
@@ -374,20 +504,29 @@ with colA:
         st.info("Sin tendencias en la ventana seleccionada.")
 
     st.subheader("🧪 Top Historias (tabla)")
-    st.dataframe(df_w[["time","time_ago_min","source","buzz_score","assets","impact","title"]].head(50), use_container_width=True, hide_index=True)
-
-    csv = df_w.to_csv(index=False).encode("utf-8")
+    st.dataframe(
+        df_w[["time","time_ago_min","source","buzz_score","assets_str","impact","title"]].rename(columns={"assets_str": "assets"}).head(50),
+        use_container_width=True, hide_index=True,
+        column_config={
+            "buzz_score": st.column_config.NumberColumn(format="%.5f"),
+            "impact": st.column_config.NumberColumn(format="%.3f"),
+        },
+    )
+
+    csv = (df_w.drop(columns=["assets"]).rename(columns={"assets_str": "assets"})
+           .round({"impact": 3, "source_weight": 3, "recency": 3, "buzz_score": 5})
+           .to_csv(index=False).encode("utf-8"))
     st.download_button("⬇️ Exportar CSV", csv, file_name="noticias_impacto.csv", mime="text/csv")
 
 with colB:
     st.subheader("📰 Historias Destacadas")
     topN = st.slider("Cuántas historias mostrar", 5, 50, 15, 5)
-    for _, r in df_w.head(topN).iterrows():
+    for r in df_w.head(topN).itertuples(index=False):
         with st.container(border=True):
-            st.markdown(f"**[{r['title']}]({r['link']})**")
-            st.caption(f"{r['source']} • hace {r['time_ago_min']} min • Buzz={r['buzz_score']} • Impacto={r['impact']} • Activos: {r['assets'] or '—'}")
-            if r["summary"]:
-                st.write(r["summary"][:400] + ("..." if len(r["summary"])>400 else ""))
+            st.markdown(f"**[{r.title}]({r.link})**")
+            st.caption(f"{r.source} • hace {r.time_ago_min} min • Buzz={r.buzz_score:.5f} • Impacto={r.impact:.3f} • Activos: {r.assets_str or '—'}")
+            if r.summary:
+                st.write(r.summary[:400] + ("..." if len(r.summary)>400 else ""))
 
 # Alertas Telegram si procede
 try:
@@ -399,11 +538,11 @@ except Exception:
 if cfg.get("enable_alerts") and cfg.get("tg_token") and cfg.get("tg_chat_id"):
     # envía alertas de los top 5 con mayor buzz por encima del umbral
     to_alert = df_w.head(5)
-    sent = 0
-    for _, r in to_alert.iterrows():
-        msg = f"🚨 <b>Noticia Impacto</b>\n<b>{r['title']}</b>\nFuente: {r['source']}\nHace: {r['time_ago_min']} min\nBuzz: {r['buzz_score']}\nActivos: {r['assets'] or '—'}\n{r['link']}"
-        ok = send_telegram(cfg["tg_token"], cfg["tg_chat_id"], msg)
-        if ok: sent += 1
+    msgs = []
+    for r in to_alert.itertuples(index=False):
+        msgs.append(f"🚨 <b>Noticia Impacto</b>\n<b>{r.title}</b>\nFuente: {r.source}\nHace: {r.time_ago_min} min\nBuzz: {r.buzz_score:.5f}\nActivos: {r.assets_str or '—'}\n{r.link}")
+    # En secuencia para que lleguen ordenadas por buzz (la sesión ya evita el handshake)
+    sent = sum(send_telegram(cfg["tg_token"], cfg["tg_chat_id"], m) for m in msgs)
     if sent:
         st.success(f"Alertas enviadas: {sent}")
 